@@ -0,0 +1,104 @@
+from keras.layers import BatchNormalization, Layer, InputSpec
+from keras import activations, initializers
+import keras.backend as K
+import tensorflow as tf
+import numpy as np
+
+
+class FusedBatchNormalization(BatchNormalization):
+	"""
+	BatchNormalization for the (batch, steps, channels) tensors of Conv1D.
+
+	Keras only dispatches to tf.nn.fused_batch_norm (a single cuDNN kernel)
+	for 4-D NHWC tensors, and builds the unfused moments/normalize graph for
+	3-D ones. This layer adds a unit height axis around the normalization so
+	that the fused kernel is used. Its weights are the same as
+	BatchNormalization's.
+
+	TF 1.13's fused_batch_norm has no activation_mode, so the optional
+	activation is applied right after it, inside the same layer, where XLA
+	fuses it with the normalization instead of a separate Activation layer.
+
+	Attributes:
+		activation (string): Activation applied to the normalized output.
+	"""
+	def __init__(self, axis=-1, activation=None, **kwargs):
+		assert axis == -1, "[FusedBatchNormalization] Only channels_last (axis=-1) is supported."
+		super(FusedBatchNormalization, self).__init__(axis=axis, **kwargs)
+		self.activation = activations.get(activation)
+
+	def call(self, inputs, training=None):
+		self._unexpanded_inputs = inputs
+
+		# FusedBatchNorm wants float32 scale/offset for half inputs, but the
+		# layer weights follow floatx, so half precision keeps the 3-D path.
+		if K.dtype(inputs) != 'float32':
+			x = super(FusedBatchNormalization, self).call(inputs, training=training)
+			return self.activation(x)
+
+		x = K.expand_dims(inputs, axis=1)
+		x = super(FusedBatchNormalization, self).call(x, training=training)
+		return self.activation(K.squeeze(x, axis=1))
+
+	def add_update(self, updates, inputs=None):
+		# BatchNormalization.call registers its moving-average updates against
+		# the 4-D tensor it normalizes, but Model looks them up by layer input.
+		if inputs is not None:
+			inputs = self._unexpanded_inputs
+		super(FusedBatchNormalization, self).add_update(updates, inputs)
+
+	def get_config(self):
+		config = {'activation': activations.serialize(self.activation)}
+		base_config = super(FusedBatchNormalization, self).get_config()
+		return dict(list(base_config.items()) + list(config.items()))
+
+
+class FlatDense(Layer):
+	"""
+	Equivalent of Flatten() followed by Dense(units) for (batch, steps, channels)
+	inputs, contracted with a single einsum so that the flattened copy of the
+	input is never materialized. The kernel has shape (steps, channels, units),
+	i.e. the Dense kernel reshaped.
+
+	Attributes:
+		units (int): Output dimension.
+		use_bias (bool): Adds a bias vector to the output.
+	"""
+	def __init__(self, units, use_bias=True, **kwargs):
+		super(FlatDense, self).__init__(**kwargs)
+		self.units = units
+		self.use_bias = use_bias
+		self.input_spec = InputSpec(ndim=3)
+
+	def build(self, input_shape):
+		self.kernel = self.add_weight(name='kernel',
+									  shape=tuple(input_shape[1:]) + (self.units,),
+									  initializer=self.kernel_initializer)
+		if self.use_bias:
+			self.bias = self.add_weight(name='bias', shape=(self.units,), initializer='zeros')
+		else:
+			self.bias = None
+
+		super(FlatDense, self).build(input_shape)
+
+	@staticmethod
+	def kernel_initializer(shape, dtype=None):
+		# Drawn as the flat (steps * channels, units) Dense kernel and reshaped,
+		# so glorot_uniform uses the same fan-in/fan-out as Flatten+Dense.
+		flat_shape = (int(np.prod(shape[:-1])), shape[-1])
+		return K.reshape(initializers.glorot_uniform()(flat_shape, dtype=dtype), shape)
+
+	def call(self, inputs):
+		outputs = tf.einsum('bdc,dco->bo', inputs, self.kernel)
+		if self.use_bias:
+			outputs = K.bias_add(outputs, self.bias)
+		return outputs
+
+	def compute_output_shape(self, input_shape):
+		return (input_shape[0], self.units)
+
+	def get_config(self):
+		config = {'units': self.units, 'use_bias': self.use_bias}
+		base_config = super(FlatDense, self).get_config()
+		return dict(list(base_config.items()) + list(config.items()))
+
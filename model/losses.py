@@ -0,0 +1,28 @@
+import keras.backend as K
+import tensorflow as tf
+
+
+# Resolved once at import: looking tf.contrib up lazily loads the whole contrib
+# package on the first build_model call instead.
+triplet_semihard_loss = tf.contrib.losses.metric_learning.triplet_semihard_loss
+
+
+# The architectures output logits, so softmax, log and NLL run as a single
+# numerically stable kernel instead of softmax followed by crossentropy. The
+# logits are upcast so that half-precision models keep a float32 loss.
+def sparse_softmax_crossentropy(y_true, y_pred):
+	labels = K.cast(K.flatten(y_true), 'int64')
+	logits = K.cast(y_pred, 'float32')
+
+	loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels, logits=logits)
+	return K.cast(loss, K.floatx())
+
+
+# Semi-hard triplet loss over `embeddings` plus the classification loss over
+# the logits. Bind `embeddings` (e.g. with functools.partial) to use it as a
+# Keras loss.
+def triplet_loss(y_true, y_pred, embeddings, margin=1.0):
+	labels = K.cast(K.flatten(y_true), 'int32')
+	triplet_contribution = triplet_semihard_loss(labels, K.cast(embeddings, 'float32'), margin=margin)
+	classification_contribution = sparse_softmax_crossentropy(y_true, y_pred)
+	return K.cast(triplet_contribution, K.floatx()) + classification_contribution
@@ -0,0 +1,46 @@
+from keras.utils import Sequence
+import numpy as np
+
+
+class ArraySequence(Sequence):
+	"""
+	Batches in-memory arrays for fit_generator/evaluate_generator, so that the
+	upcoming batches are sliced by a background worker while the current one
+	is being computed.
+
+	Attributes:
+		x (array, list or dict): Model inputs, by position or by input name.
+		y (array): Labels.
+		batch_size (int): Samples per batch.
+		shuffle (bool): Reshuffles the samples at the end of every epoch.
+	"""
+	def __init__(self, x, y, batch_size=32, shuffle=False):
+		self.x = x
+		self.y = y
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+
+		self.indices = np.arange(len(y))
+		if self.shuffle:
+			np.random.shuffle(self.indices)
+
+	def __len__(self):
+		return int(np.ceil(len(self.indices) / float(self.batch_size)))
+
+	def __getitem__(self, index):
+		# Sorted indices keep the gather as sequential as possible in memory.
+		batch = np.sort(self.indices[index * self.batch_size : (index + 1) * self.batch_size])
+		return self.take(self.x, batch), self.y[batch]
+
+	def on_epoch_end(self):
+		if self.shuffle:
+			np.random.shuffle(self.indices)
+
+	@staticmethod
+	def take(data, indices):
+		if isinstance(data, dict):
+			return {name: values[indices] for name, values in data.items()}
+		elif isinstance(data, (list, tuple)):
+			return [values[indices] for values in data]
+		else:
+			return data[indices]
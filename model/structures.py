@@ -1,28 +1,360 @@
 import keras.backend as K
 import tensorflow as tf
+import numpy as np
+import subprocess
+import os
+from tensorflow.core.protobuf import rewriter_config_pb2
+from tensorflow.contrib.compiler import jit
+from contextlib import ExitStack, contextmanager
+from functools import partial, update_wrapper
 
 
 from keras.layers import BatchNormalization, Activation, MaxPooling1D, SpatialDropout1D
-from keras.layers import Input, Flatten, Conv1D, GlobalAveragePooling1D
-from keras.layers import Concatenate, Lambda, Dense, LSTM, Dropout
-from model.metrics import APCER, BPCER, ACER
+from keras.layers import Input, InputLayer, Conv1D, GlobalAveragePooling1D
+from keras.layers import Add, Concatenate, Lambda, Dense, LSTM, Dropout, Reshape, ZeroPadding1D, Cropping1D
+from model.metrics import APCER, BPCER, ACER, acc
+from model.losses import sparse_softmax_crossentropy, triplet_loss
+from model.pipeline import ArraySequence
+from model.layers import FusedBatchNormalization, FlatDense
 from keras.optimizers import Adam
 from keras.models import Model
 
 
+def xla_scope(strides):
+	# Stride-1 convolutions run slower under XLA than through cuDNN (while
+	# stride-2 ones run faster), so their ops are kept out of the JIT clusters
+	# that the enclosing model's jit scope would otherwise form around them.
+	if strides == 1:
+		return jit.experimental_jit_scope(compile_ops=False)
+	return ExitStack()
+
+
+def Im2RowConv1D(input_layer, filters, kernel_size, strides=1):
+	# Valid, bias-free Conv1D for inputs with only a handful of channels (the
+	# RGB traces or the rPPG signal). cuDNN/MKL-DNN spend most of such a
+	# convolution reordering the narrow input, so the sliding windows are
+	# materialized instead and projected with a Dense. The Dense kernel is the
+	# Conv1D kernel reshaped to (kernel_size * channels, filters).
+	channels = K.int_shape(input_layer)[-1]
+
+	x = Lambda(lambda t: tf.signal.frame(t, kernel_size, strides, axis=1))(input_layer)
+	x = Reshape((-1, kernel_size * channels))(x)
+	return Dense(filters, use_bias=False)(x)
+
+
+def AlignedConv1D(input_layer, filters, kernel_size, strides=1, multiple=None):
+	# Valid, bias-free Conv1D that, given a `multiple`, runs on an input
+	# zero-padded on the right so that the convolution's output length is a
+	# multiple of it. MKL-DNN then runs its vectorized loops without a scalar
+	# tail. The positions that only exist because of the padding are cropped
+	# afterwards, so the result (and the weights) are exactly those of the
+	# plain Conv1D. This only pays off on CPU: on GPU the pad and crop are two
+	# extra memory-bound ops per layer, hence it is off by default.
+	steps, crop = K.int_shape(input_layer)[1], 0
+	if steps is not None and multiple:
+		output_steps = (steps - kernel_size) // strides + 1
+		aligned_steps = -(-output_steps // multiple) * multiple
+
+		padding = (aligned_steps - 1) * strides + kernel_size - steps
+		if padding > 0:
+			input_layer = ZeroPadding1D((0, padding))(input_layer)
+			crop = aligned_steps - output_steps
+
+	with xla_scope(strides=strides):
+		x = Conv1D(filters, kernel_size=kernel_size, strides=strides, activation='linear', use_bias=False, data_format='channels_last')(input_layer)
+
+	if crop > 0:
+		x = Cropping1D((0, crop))(x)
+	return x
+
+
+def l2_normalize(x):
+	# x / sqrt(sum(x^2)) as a single rsqrt and multiply, which XLA fuses with
+	# the reduction into one kernel.
+	return x * tf.rsqrt(K.sum(K.square(x), axis=1, keepdims=True) + K.epsilon())
+
+
+@contextmanager
+def backend_precision(dtype):
+	# Switches the process-wide Keras floatx for the duration of the block, with
+	# an epsilon that does not underflow in half precision, then restores both.
+	floatx, epsilon = K.floatx(), K.epsilon()
+
+	K.set_floatx(dtype)
+	if dtype == 'float16':
+		K.set_epsilon(1e-4)
+
+	try:
+		yield
+	finally:
+		K.set_floatx(floatx)
+		K.set_epsilon(epsilon)
+
+
+# Whether an architecture already installed (or found) the Keras session.
+_session_installed = False
+
+
+def fold_batch_norm(layer, batch_norm):
+	# Returns the kernel and bias of `layer` (a Conv1D or Dense) with the
+	# inference-time affine transform of the following `batch_norm` folded in.
+	# Computed in float32 even for half-precision models.
+	gamma, beta, mean, variance = [w.astype('float32') for w in batch_norm.get_weights()]
+	scale = gamma / np.sqrt(variance + batch_norm.epsilon)
+
+	weights = [w.astype('float32') for w in layer.get_weights()]
+	bias = weights[1] if layer.use_bias else np.zeros_like(mean)
+
+	return [weights[0] * scale, (bias - mean) * scale + beta]
+
+
 class GenericArchitecture:
-	def __init__(self, shape, lr=1e-4, verbose=False):
+	METRICS = (acc,)
+	# Output length multiple for AlignedConv1D, e.g. 16 for CPU-only runs.
+	ALIGN_STEPS = None
+
+	def __init__(self, shape, lr=1e-4, verbose=False, use_xla=True):
+		global _session_installed
+
 		self.learning_rate = lr
 		self.verbose = verbose
+		self.use_xla = use_xla
+		self.shape = shape
+		self.frozen = False
+
+		# All architectures share one Keras session: replacing it would leave the
+		# variables of previously built models uninitialized. A default session
+		# set up by the caller is kept as is.
+		if not _session_installed and tf.get_default_session() is None:
+			K.set_session(self.build_session())
+		_session_installed = True
+
+		with self.jit_scope():
+			model = self.build_model(input_shape=shape)
+		self.model = self.compile_model(model)
+
+	def jit_scope(self):
+		# XLA is selected per model by marking the ops it builds, rather than by
+		# the shared session. The stride-1 xla_scope opt-outs nest inside.
+		return jit.experimental_jit_scope(compile_ops=self.use_xla)
+
+	def build_loss(self, model):
+		return sparse_softmax_crossentropy
+
+	def compile_model(self, model):
+		# The optimizer is created per model, as Keras optimizers keep their
+		# slot variables bound to the first model they train.
+		model.compile(
+			optimizer=Adam(lr=self.learning_rate),
+			loss=self.build_loss(model),
+			metrics=list(self.METRICS)
+		)
+		if self.verbose:
+			model.summary()
 
-		self.model = self.build_model(input_shape=shape)
+		return model
+
+	@staticmethod
+	def build_session():
+		config = tf.ConfigProto()
+
+		# The layers are pinned to channels_last, so the NHWC<->NCHW transposes
+		# the layout optimizer would insert around each Conv1D are pure overhead.
+		config.graph_options.rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.OFF
+
+		return tf.Session(config=config)
 
 	def fit(self, **kwargs):
 		kwargs['verbose'] = self.verbose
-		self.model.fit(**kwargs)
 
-	def evaluate(self, x, y):
-		evaluation = self.model.evaluate(x, y, verbose=self.verbose)
+		# In-memory arrays go through a Sequence so that batches are prepared
+		# by a background worker, overlapping with the training step.
+		uses_arrays = 'x' in kwargs and 'y' in kwargs
+		if uses_arrays and not any(k in kwargs for k in ('validation_split', 'sample_weight', 'steps_per_epoch')):
+			sequence = ArraySequence(kwargs.pop('x'), kwargs.pop('y'),
+									 batch_size=kwargs.pop('batch_size', 32),
+									 shuffle=kwargs.pop('shuffle', True))
+			self.model.fit_generator(sequence, workers=1, use_multiprocessing=False, **kwargs)
+		else:
+			self.model.fit(**kwargs)
+
+	def freeze_for_inference(self, dtype='float32'):
+		# Rebuilds the trained model without the BatchNormalization layers that
+		# directly follow a Conv1D/Dense, folding them into that layer instead.
+		# A GlobalAveragePooling1D reached from such a layer only through
+		# positively homogeneous layers (ReLU, max pooling, dropout) becomes a
+		# plain sum, with the 1/steps factor folded into the layer as well.
+		# Meant to be called after fit() and before evaluate()/predict().
+		#
+		# dtype='float16' also casts the model to half precision, which halves
+		# the memory traffic of these bandwidth-bound models. It is inference
+		# only: Keras 2.2.4 has no float32 master weights, so training in
+		# float16 would round most Adam updates away.
+		with backend_precision(dtype):
+			if K.dtype(self.model.weights[0]) != dtype:
+				assert not self.frozen, "[GenericArchitecture] The precision can only change on the first freeze."
+
+				with self.jit_scope():
+					model = self.build_model(input_shape=self.shape)
+				model.set_weights(self.model.get_weights())
+				self.model = model
+
+			with self.jit_scope():
+				model = self.fold_model()
+			self.model = self.compile_model(model)
+			self.frozen = True
+
+		return self.model
+
+	def fold_model(self):
+		sources, consumers = {}, {}
+		for layer in self.model.layers:
+			sources[layer.name] = self.inbound_layers(layer)
+			for source in sources[layer.name]:
+				consumers[source.name] = consumers.get(source.name, 0) + 1
+
+		folded = {}
+		for layer in self.model.layers:
+			if not isinstance(layer, BatchNormalization) or layer.axis not in (-1, 2):
+				continue
+
+			# Cropping commutes with the per-channel BN transform.
+			source = sources[layer.name][0]
+			while isinstance(source, Cropping1D) and consumers[source.name] == 1:
+				source = sources[source.name][0]
+
+			if isinstance(source, (Conv1D, Dense)) and consumers[source.name] == 1:
+				folded[source.name] = layer
+
+		scales, summed = {}, set()
+		for layer in self.model.layers:
+			steps = layer.input_shape[1] if isinstance(layer, GlobalAveragePooling1D) else None
+			if steps is None:
+				continue
+
+			source = sources[layer.name][0]
+			while consumers[source.name] == 1 and self.is_homogeneous(source, sources, folded):
+				source = sources[source.name][0]
+
+			if isinstance(source, (Conv1D, Dense)) and consumers[source.name] == 1 \
+				and source.get_config()['activation'] in ('linear', 'relu'):
+				scales[source.name] = 1.0 / steps
+				summed.add(layer.name)
+
+		tensors = {}
+		for layer in self.model.layers:
+			if isinstance(layer, InputLayer):
+				tensors[layer.name] = Input(batch_shape=layer.batch_input_shape,
+											dtype=layer.dtype,
+											name=layer.name)
+				continue
+
+			inbound_layers = sources[layer.name]
+			inbound = [tensors[inbound_layer.name] for inbound_layer in inbound_layers]
+			inbound = inbound[0] if len(inbound) == 1 else inbound
+
+			# Stride-1 convolutions keep their XLA opt-out in the rebuilt graph.
+			strides = layer.strides[0] if isinstance(layer, Conv1D) else None
+
+			if layer.name in folded or layer.name in scales:
+				if layer.name in folded:
+					weights = fold_batch_norm(layer, folded[layer.name])
+				else:
+					weights = layer.get_weights()
+				weights = [w * scales.get(layer.name, 1.0) for w in weights]
+
+				config = layer.get_config()
+				config['use_bias'] = len(weights) == 2
+				if layer.name in folded:
+					config['activation'] = folded[layer.name].get_config().get('activation', 'linear')
+
+				fused_layer = layer.__class__.from_config(config)
+				with xla_scope(strides=strides):
+					tensors[layer.name] = fused_layer(inbound)
+				fused_layer.set_weights(weights)
+			elif any(norm is layer for norm in folded.values()):
+				tensors[layer.name] = inbound
+			elif layer.name in summed:
+				tensors[layer.name] = Lambda(lambda x : K.sum(x, axis=1), name=layer.name)(inbound)
+			else:
+				with xla_scope(strides=strides):
+					tensors[layer.name] = layer(inbound)
+
+		inputs = [tensors[x._keras_history[0].name] for x in self.model.inputs]
+		outputs = [tensors[x._keras_history[0].name] for x in self.model.outputs]
+
+		return Model(inputs, outputs)
+
+	def inbound_layers(self, layer):
+		# Layers reused by a frozen rebuild have one inbound node per model, so
+		# the node that belongs to self.model is looked up explicitly.
+		for index, node in enumerate(layer._inbound_nodes):
+			if '{}_ib-{}'.format(layer.name, index) in self.model._network_nodes:
+				return node.inbound_layers
+		return []
+
+	@staticmethod
+	def is_homogeneous(layer, sources, folded):
+		# Whether f(a * x) == a * f(x) for a > 0 at inference time.
+		if isinstance(layer, BatchNormalization):
+			return any(norm is layer for norm in folded.values()) and \
+				layer.get_config().get('activation', 'linear') in ('linear', 'relu')
+		elif isinstance(layer, Activation):
+			return layer.get_config()['activation'] in ('linear', 'relu')
+		else:
+			return isinstance(layer, (MaxPooling1D, Dropout, Cropping1D))
+
+	def aot_compile(self, output_path, batch_size=1, cpp_class='RPPGInference', tfcompile='tfcompile'):
+		# Compiles the model ahead of time with XLA's tfcompile into an object
+		# file and a C++ header exposing `cpp_class`, which runs the fixed-shape
+		# forward pass (logits) without a TensorFlow session. Best called after
+		# freeze_for_inference(). tfcompile is not part of the pip package; it
+		# is built from source (//tensorflow/compiler/aot:tfcompile).
+		if not os.path.isdir(output_path):
+			os.makedirs(output_path)
+
+		session = K.get_session()
+		fetches = [x.op.name for x in self.model.outputs]
+		graph_def = tf.graph_util.convert_variables_to_constants(session,
+																 session.graph.as_graph_def(),
+																 fetches)
+
+		graph_path = os.path.join(output_path, 'model.pb')
+		with open(graph_path, 'wb') as file:
+			file.write(graph_def.SerializeToString())
+
+		# tf2xla.Config in text format: the feeds need fully defined shapes.
+		config_path = os.path.join(output_path, 'model.config.pbtxt')
+		with open(config_path, 'w') as file:
+			for x in self.model.inputs:
+				dims = [batch_size] + list(K.int_shape(x)[1:])
+				dims = ' '.join('dim {{ size: {} }}'.format(d) for d in dims)
+				file.write('feed {{ id {{ node_name: "{}" }} shape {{ {} }} }}\n'.format(x.op.name, dims))
+
+			for name in fetches:
+				file.write('fetch {{ id {{ node_name: "{}" }} }}\n'.format(name))
+
+		prefix = os.path.join(output_path, cpp_class.lower())
+		subprocess.check_call([tfcompile,
+							   '--graph={}'.format(graph_path),
+							   '--config={}'.format(config_path),
+							   '--cpp_class={}'.format(cpp_class),
+							   '--target_triple=x86_64-pc-linux',
+							   '--out_header={}.h'.format(prefix),
+							   '--out_function_object={}.o'.format(prefix),
+							   '--out_metadata_object={}_metadata.o'.format(prefix),
+							   '--xla_cpu_enable_fast_math=true'])
+
+		return '{}.h'.format(prefix), '{}.o'.format(prefix)
+
+	def evaluate(self, x, y, batch_size=32):
+		# Same background batching as fit(), so slicing the next batch overlaps
+		# with the current evaluation step.
+		sequence = ArraySequence(x, y, batch_size=batch_size)
+		evaluation = self.model.evaluate_generator(sequence,
+												   workers=1,
+												   use_multiprocessing=False,
+												   verbose=self.verbose)
 		return dict(zip(self.model.metrics_names, evaluation))
 
 	def get_model(self):
@@ -32,19 +364,9 @@ class GenericArchitecture:
 class FlatRGB(GenericArchitecture):
 	def build_model(self, input_shape):
 		input_layer = Input(shape=input_shape)
-		x = Flatten()(input_layer)
-		x = Dense(2, activation='softmax')(x)
+		x = FlatDense(2)(input_layer)
 
-		model = Model(input_layer, x)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
-
-		return model
+		return Model(input_layer, x)
 
 	@staticmethod
 	def uses_rppg():
@@ -55,25 +377,15 @@ class SimpleConvolutionalRGB(GenericArchitecture):
 	def build_model(self, input_shape):
 		input_layer = Input(shape=input_shape)
 		
-		x = Conv1D(64, kernel_size=5, strides=1, activation='linear', use_bias=False)(input_layer)
-		x = BatchNormalization()(x)
-		x = Activation('relu')(x)
+		x = Im2RowConv1D(input_layer, 64, kernel_size=5, strides=1)
+		x = FusedBatchNormalization(activation='relu')(x)
 		x = MaxPooling1D(pool_size=3, strides=2)(x)
 
 		x = GlobalAveragePooling1D()(x)
 
-		x = Dense(2, activation='softmax')(x)
-
-		model = Model(input_layer, x)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
+		x = Dense(2, activation='linear')(x)
 
-		return model
+		return Model(input_layer, x)
 
 	@staticmethod
 	def uses_rppg():
@@ -81,26 +393,26 @@ class SimpleConvolutionalRGB(GenericArchitecture):
 
 class SimpleResnetRGB(GenericArchitecture):
 	def build_model(self, input_shape):
-		from keras.layers import Add
-
 		input_layer = Input(shape=input_shape)
 
 		def resnet_identity_block(input_layer, filters):
-			x = Conv1D(filters, kernel_size=5, strides=1, padding='same', activation='relu')(input_layer)
-			x = Conv1D(filters, kernel_size=5, strides=1, padding='same', activation='linear')(x)
+			with xla_scope(strides=1):
+				x = Conv1D(filters, kernel_size=5, strides=1, padding='same', activation='relu', data_format='channels_last')(input_layer)
+				x = Conv1D(filters, kernel_size=5, strides=1, padding='same', activation='linear', data_format='channels_last')(x)
 			x = Add()([x, input_layer])
 			return Activation('relu')(x)
 
 		def resnet_residual_block(input_layer, filters):
-			x = Conv1D(filters, kernel_size=5, strides=2, activation='relu')(input_layer)
-			x = Conv1D(filters, kernel_size=5, strides=1, padding='same', activation='linear')(x)
+			x = Conv1D(filters, kernel_size=5, strides=2, activation='relu', data_format='channels_last')(input_layer)
+			with xla_scope(strides=1):
+				x = Conv1D(filters, kernel_size=5, strides=1, padding='same', activation='linear', data_format='channels_last')(x)
 		
-			input_layer = Conv1D(filters, kernel_size=5, strides=2, activation='linear')(input_layer)
+			input_layer = Conv1D(filters, kernel_size=5, strides=2, activation='linear', data_format='channels_last')(input_layer)
 			
 			x = Add()([x, input_layer])
 			return Activation('relu')(x)
 		
-		x = Conv1D(64, kernel_size=5, strides=2, activation='relu')(input_layer)
+		x = Conv1D(64, kernel_size=5, strides=2, activation='relu', data_format='channels_last')(input_layer)
 
 		for i in range(3):
 			x = resnet_identity_block(x, 64)
@@ -118,18 +430,9 @@ class SimpleResnetRGB(GenericArchitecture):
 		# 	x = resnet_identity_block(x, 512)
 
 		x = GlobalAveragePooling1D()(x)
-		x = Dense(2, activation='softmax')(x)
+		x = Dense(2, activation='linear')(x)
 
-		model = Model(input_layer, x)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
-
-		return model
+		return Model(input_layer, x)
 
 	@staticmethod
 	def uses_rppg():
@@ -137,27 +440,27 @@ class SimpleResnetRGB(GenericArchitecture):
 
 class SimpleResnetRPPG(GenericArchitecture):
 	def build_model(self, input_shape):
-		from keras.layers import Add
-
 		input_layer = Input(shape=input_shape)
 
 		def resnet_identity_block(input_layer, filters):
-			x = Conv1D(filters, kernel_size=3, strides=1, padding='same', activation='relu')(input_layer)
-			x = Conv1D(filters, kernel_size=3, strides=1, padding='same', activation='linear')(x)
+			with xla_scope(strides=1):
+				x = Conv1D(filters, kernel_size=3, strides=1, padding='same', activation='relu', data_format='channels_last')(input_layer)
+				x = Conv1D(filters, kernel_size=3, strides=1, padding='same', activation='linear', data_format='channels_last')(x)
 			x = Add()([x, input_layer])
 			return Activation('relu')(x)
 
 		def resnet_residual_block(input_layer, filters):
-			x = Conv1D(filters, kernel_size=3, strides=2, activation='relu')(input_layer)
-			x = Conv1D(filters, kernel_size=3, strides=1, padding='same', activation='linear')(x)
+			x = Conv1D(filters, kernel_size=3, strides=2, activation='relu', data_format='channels_last')(input_layer)
+			with xla_scope(strides=1):
+				x = Conv1D(filters, kernel_size=3, strides=1, padding='same', activation='linear', data_format='channels_last')(x)
 		
-			input_layer = Conv1D(filters, kernel_size=3, strides=2, activation='linear')(input_layer)
+			input_layer = Conv1D(filters, kernel_size=3, strides=2, activation='linear', data_format='channels_last')(input_layer)
 			
 			x = Add()([x, input_layer])
 			return Activation('relu')(x)
 		
 		factor = 32
-		x = Conv1D(factor, kernel_size=3, strides=2, activation='relu')(input_layer)
+		x = Conv1D(factor, kernel_size=3, strides=2, activation='relu', data_format='channels_last')(input_layer)
 
 		for i in range(3):
 			x = resnet_identity_block(x, factor)
@@ -176,18 +479,9 @@ class SimpleResnetRPPG(GenericArchitecture):
 
 		x = GlobalAveragePooling1D()(x)
 
-		x = Dense(2, activation='softmax')(x)
-
-		model = Model(input_layer, x)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
+		x = Dense(2, activation='linear')(x)
 
-		return model
+		return Model(input_layer, x)
 
 	@staticmethod
 	def uses_rppg():
@@ -196,30 +490,19 @@ class SimpleResnetRPPG(GenericArchitecture):
 class DeepConvolutionalRGB(GenericArchitecture):
 	def build_model(self, input_shape):
 		input_layer = Input(shape=input_shape)
-		x = Conv1D(64, kernel_size=5, strides=1, activation='linear', use_bias=False)(input_layer)
-		x = BatchNormalization()(x)
-		x = Activation('relu')(x)
+		x = Im2RowConv1D(input_layer, 64, kernel_size=5, strides=1)
+		x = FusedBatchNormalization(activation='relu')(x)
 		x = MaxPooling1D(pool_size=3, strides=2)(x)
 
-		x = Conv1D(128, kernel_size=5, strides=1, activation='linear', use_bias=False)(x)
-		x = BatchNormalization()(x)
-		x = Activation('relu')(x)
+		x = AlignedConv1D(x, 128, kernel_size=5, strides=1, multiple=self.ALIGN_STEPS)
+		x = FusedBatchNormalization(activation='relu')(x)
 		x = MaxPooling1D(pool_size=3, strides=2)(x)
 
 		x = GlobalAveragePooling1D()(x)
 
-		x = Dense(2, activation='softmax')(x)
+		x = Dense(2, activation='linear')(x)
 
-		model = Model(input_layer, x)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
-
-		return model
+		return Model(input_layer, x)
 
 	@staticmethod
 	def uses_rppg():
@@ -227,137 +510,72 @@ class DeepConvolutionalRGB(GenericArchitecture):
 
 
 class FlatRPPG(GenericArchitecture):
-	def __init__(self, shape, lr=1e-4, verbose=False):
-		self.learning_rate = lr
-		self.verbose = verbose
-
-		self.model = self.build_model(input_shape=shape)
-
 	def build_model(self, input_shape):
 		input_rgb = Input(shape=input_shape, name='input_rgb')
 		input_ppg = Input(shape=input_shape, name='input_ppg')
 		
-		rgb_branch = Flatten()(input_rgb)
-		ppg_branch = Flatten()(input_ppg)
+		# Dense(W)([rgb; ppg]) == Dense(W_rgb)(rgb) + Dense(W_ppg)(ppg), which
+		# skips materializing the concatenated tensor.
+		rgb_branch = FlatDense(2)(input_rgb)
+		ppg_branch = FlatDense(2, use_bias=False)(input_ppg)
 
-		combined_branch = Concatenate()([rgb_branch, ppg_branch])
-		combined_branch = Dense(2, activation='softmax')(combined_branch)
-
-		model = Model(input_ppg, combined_branch)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
+		combined_branch = Add()([rgb_branch, ppg_branch])
 
-		return model
+		return Model([input_rgb, input_ppg], combined_branch)
 
 	@staticmethod
 	def uses_rppg():
 		return True
 
 class SimpleConvolutionalRPPG(GenericArchitecture):
-	def __init__(self, shape, lr=1e-4, verbose=False):
-		self.learning_rate = lr
-		self.verbose = verbose
-
-		self.model = self.build_model(input_shape=shape)
-
 	def build_model(self, input_shape):
 		input_ppg = Input(shape=input_shape, name='input_ppg')
 		
-		ppg_branch = Conv1D(64, kernel_size=7,
-								strides=1,
-								activation='linear',
-								use_bias=False)(input_ppg)
+		ppg_branch = Im2RowConv1D(input_ppg, 64, kernel_size=7, strides=1)
 
-		ppg_branch = BatchNormalization()(ppg_branch)
-		ppg_branch = Activation('relu')(ppg_branch)
+		ppg_branch = FusedBatchNormalization(activation='relu')(ppg_branch)
 
 		ppg_branch = GlobalAveragePooling1D()(ppg_branch)
 
-		ppg_branch = Dense(2, activation='softmax')(ppg_branch)
+		ppg_branch = Dense(2, activation='linear')(ppg_branch)
 
-		model = Model(input_ppg, ppg_branch)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
-
-		return model
+		return Model(input_ppg, ppg_branch)
 
 	@staticmethod
 	def uses_rppg():
 		return True
 
 class LSTM_RPPG(GenericArchitecture):
-	def __init__(self, shape, lr=1e-4, verbose=False):
-		self.learning_rate = lr
-		self.verbose = verbose
-
-		self.model = self.build_model(input_shape=shape)
-
 	def build_model(self, input_shape):
 		input_ppg = Input(shape=input_shape, name='input_ppg')
 		
 		ppg_branch = LSTM(32)(input_ppg)
 
-		ppg_branch = Dense(2, activation='softmax')(ppg_branch)
+		ppg_branch = Dense(2, activation='linear')(ppg_branch)
 
-		model = Model(input_ppg, ppg_branch)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
-
-		return model
+		return Model(input_ppg, ppg_branch)
 
 	@staticmethod
 	def uses_rppg():
 		return True
 
 class CNN_LSTM_RPPG(GenericArchitecture):
-	def __init__(self, shape, lr=1e-4, verbose=False):
-		self.learning_rate = lr
-		self.verbose = verbose
-
-		self.model = self.build_model(input_shape=shape)
-
 	def build_model(self, input_shape):
 		input_ppg = Input(shape=input_shape, name='input_ppg')
 		
-		ppg_branch = Conv1D(16, kernel_size=5, activation='linear', use_bias=False)(input_ppg)
-		ppg_branch = BatchNormalization()(ppg_branch)
-		ppg_branch = Activation('relu')(ppg_branch)
+		ppg_branch = Im2RowConv1D(input_ppg, 16, kernel_size=5)
+		ppg_branch = FusedBatchNormalization(activation='relu')(ppg_branch)
 		ppg_branch = MaxPooling1D(pool_size=3, strides=2)(ppg_branch)
 
-		ppg_branch = Conv1D(32, kernel_size=5, activation='linear', use_bias=False)(ppg_branch)
-		ppg_branch = BatchNormalization()(ppg_branch)
-		ppg_branch = Activation('relu')(ppg_branch)
+		ppg_branch = AlignedConv1D(ppg_branch, 32, kernel_size=5, multiple=self.ALIGN_STEPS)
+		ppg_branch = FusedBatchNormalization(activation='relu')(ppg_branch)
 		ppg_branch = MaxPooling1D(pool_size=3, strides=2)(ppg_branch)
 
 		ppg_branch = LSTM(32)(ppg_branch)
 
-		ppg_branch = Dense(2, activation='softmax')(ppg_branch)
-
-		model = Model(input_ppg, ppg_branch)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
+		ppg_branch = Dense(2, activation='linear')(ppg_branch)
 
-		return model
+		return Model(input_ppg, ppg_branch)
 
 	@staticmethod
 	def uses_rppg():
@@ -365,98 +583,69 @@ class CNN_LSTM_RPPG(GenericArchitecture):
 
 
 class DeepConvolutionalRPPG(GenericArchitecture):
-	def __init__(self, shape, lr=1e-4, verbose=False):
-		self.learning_rate = lr
-		self.verbose = verbose
-
-		self.model = self.build_model(input_shape=shape)
-
 	def build_model(self, input_shape):
 		input_ppg = ppg_branch = Input(shape=input_shape, name='input_ppg')
 
 		for f in [64, 128, 256]:
-			ppg_branch = Conv1D(f, kernel_size=7, strides=1, activation='linear', use_bias=False)(ppg_branch)
-			ppg_branch = BatchNormalization()(ppg_branch)
-			ppg_branch = Activation('relu')(ppg_branch)
+			if ppg_branch is input_ppg:
+				ppg_branch = Im2RowConv1D(ppg_branch, f, kernel_size=7, strides=1)
+			else:
+				ppg_branch = AlignedConv1D(ppg_branch, f, kernel_size=7, strides=1, multiple=self.ALIGN_STEPS)
+			ppg_branch = FusedBatchNormalization(activation='relu')(ppg_branch)
 			
 			ppg_branch = MaxPooling1D(pool_size=2, strides=2)(ppg_branch)
 			ppg_branch = Dropout(0.2)(ppg_branch)
 
 		ppg_branch = GlobalAveragePooling1D()(ppg_branch)
-		ppg_branch = Dense(2, activation='softmax')(ppg_branch)
-
-		model = Model(input_ppg, ppg_branch)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss='sparse_categorical_crossentropy',
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
+		ppg_branch = Dense(2, activation='linear')(ppg_branch)
 
-		return model
+		return Model(input_ppg, ppg_branch)
 
 	@staticmethod
 	def uses_rppg():
 		return True
 
 
-class TripletRGB(GenericArchitecture):
+class TripletArchitecture(GenericArchitecture):
+	# Architectures whose model has an 'embeddings' layer, trained with the
+	# triplet loss on it on top of the classification loss.
+	def build_loss(self, model):
+		# The last node is the one of the most recent (e.g. frozen) rebuild.
+		embeddings = model.get_layer('embeddings').get_output_at(-1)
+		return update_wrapper(partial(triplet_loss, embeddings=embeddings, margin=1.0), triplet_loss)
+
+
+class TripletRGB(TripletArchitecture):
 	def build_model(self, input_shape):
 		input_layer = Input(shape=input_shape)
-		embeddings = Conv1D(64, kernel_size=5, strides=2, activation='linear', use_bias=False)(input_layer)
-		embeddings = BatchNormalization()(embeddings)
-		embeddings = Activation('relu')(embeddings)
+		embeddings = Im2RowConv1D(input_layer, 64, kernel_size=5, strides=2)
+		embeddings = FusedBatchNormalization(activation='relu')(embeddings)
 
-		embeddings = Conv1D(128, kernel_size=5, strides=2, activation='linear', use_bias=False)(embeddings)
-		embeddings = BatchNormalization()(embeddings)
-		embeddings = Activation('relu')(embeddings)
+		embeddings = AlignedConv1D(embeddings, 128, kernel_size=5, strides=2, multiple=self.ALIGN_STEPS)
+		embeddings = FusedBatchNormalization(activation='relu')(embeddings)
 
 		embeddings = GlobalAveragePooling1D()(embeddings)
-		embeddings = Lambda(lambda x : K.l2_normalize(x, axis=1))(embeddings)
-		classification = Dense(2, activation='softmax')(embeddings)
-
-		def triplet_loss(margin=1.0):
-			triplet_semihard_loss = tf.contrib.losses.metric_learning.triplet_semihard_loss
-			def __triplet_loss(y_true, y_pred):
-				from keras.losses import sparse_categorical_crossentropy
-				triplet_contribution = triplet_semihard_loss(K.argmax(y_true, axis=1), embeddings)
-				classification_contribution = sparse_categorical_crossentropy(y_true, y_pred)
-				return triplet_contribution + classification_contribution
+		embeddings = Lambda(l2_normalize, name='embeddings')(embeddings)
+		classification = Dense(2, activation='linear')(embeddings)
 
-			return __triplet_loss
-
-		model = Model(input_layer, classification)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss=triplet_loss(margin=1.0),
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
-
-		return model
+		return Model(input_layer, classification)
 
 	@staticmethod
 	def uses_rppg():
 		return False
 
 
-class TripletRPPG(GenericArchitecture):
-	def __init__(self, shape, lr=1e-4, verbose=False):
-		self.learning_rate = lr
-		self.verbose = verbose
-
-		self.model = self.build_model(input_shape=shape)
-
+class TripletRPPG(TripletArchitecture):
 	def build_model(self, input_shape):
 		input_rgb = Input(shape=input_shape, name='input_rgb')
 		input_ppg = Input(shape=input_shape, name='input_ppg')
 		
 		def ConvWithBN(input_layer, filters):
-			x = Conv1D(filters, kernel_size=5, strides=1, activation='linear', use_bias=False)(input_layer)
-			x = BatchNormalization()(x)
-			x = Activation('relu')(x)
+			if input_layer is input_rgb or input_layer is input_ppg:
+				x = Im2RowConv1D(input_layer, filters, kernel_size=5, strides=1)
+			else:
+				x = AlignedConv1D(input_layer, filters, kernel_size=5, strides=1, multiple=self.ALIGN_STEPS)
+			x = FusedBatchNormalization(activation='relu')(x)
 			return MaxPooling1D(pool_size=3, strides=2)(x)
 
 		rgb_branch = ConvWithBN(input_rgb, 64)
@@ -469,30 +658,11 @@ class TripletRPPG(GenericArchitecture):
 		ppg_branch = GlobalAveragePooling1D()(ppg_branch)
 
 		combined_branch = Concatenate()([rgb_branch, ppg_branch])
-		embeddings = Lambda(lambda x : K.l2_normalize(x, axis=1))(combined_branch)
+		embeddings = Lambda(l2_normalize, name='embeddings')(combined_branch)
 
-		classification = Dense(2, activation='softmax')(embeddings)
+		classification = Dense(2, activation='linear')(embeddings)
 		
-		def triplet_loss(margin=1.0):
-			triplet_semihard_loss = tf.contrib.losses.metric_learning.triplet_semihard_loss
-			def __triplet_loss(y_true, y_pred):
-				from keras.losses import sparse_categorical_crossentropy
-				triplet_contribution = triplet_semihard_loss(K.argmax(y_true, axis=1), embeddings)
-				classification_contribution = sparse_categorical_crossentropy(y_true, y_pred)
-				return triplet_contribution + classification_contribution
-
-			return __triplet_loss
-
-		model = Model([input_rgb, input_ppg], classification)
-		model.compile(
-			optimizer=Adam(lr=self.learning_rate),
-			loss=triplet_loss(margin=1.0),
-			metrics=['acc']
-		)
-		if self.verbose:
-			model.summary()
-
-		return model
+		return Model([input_rgb, input_ppg], classification)
 
 	@staticmethod
 	def uses_rppg():